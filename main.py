@@ -1,63 +1,147 @@
+import asyncio
+import functools
+import hashlib
+import io
 import os
-from typing import Dict, List, Optional
-from fastapi import FastAPI, HTTPException, Request
+import re
+import time
+from typing import Dict, List, Optional, Tuple
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel
-from openai import OpenAI
+from fastapi.middleware.gzip import GZipMiddleware
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipResponder
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, ConfigDict, Field
+from openai import APIError, AsyncOpenAI
+import httpx
+import redis.asyncio as redis
+from aiolimiter import AsyncLimiter
 import json
 import logging
+import orjson
 
 # Set up logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
+logger = logging.LoggerAdapter(logging.getLogger(__name__), {"service": "competitor-analysis"})
 
-app = FastAPI(title="Loyalty Competitor Analysis Service")
+app = FastAPI(title="Loyalty Competitor Analysis Service", default_response_class=ORJSONResponse)
 
 # Add CORS middleware with Vercel domains
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # Allow all origins temporarily
     allow_credentials=False,  # Set to False since we don't need credentials
-    allow_methods=["GET", "POST", "OPTIONS"],
-    allow_headers=["Content-Type", "Authorization", "Accept", "Origin"],
-    expose_headers=["Content-Length"],
+    allow_methods=["GET", "POST"],  # Preflight OPTIONS requests are answered by the middleware
+    allow_headers=["Content-Type", "Authorization", "If-None-Match"],
+    expose_headers=["Content-Length", "ETag"],
     max_age=3600  # Cache preflight requests for 1 hour
 )
 
+class SelectiveGZipMiddleware(GZipMiddleware):
+    """GZip responses except Server-Sent Events, which gzip would hold back until its buffer fills."""
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or "gzip" not in Headers(scope=scope).get("Accept-Encoding", ""):
+            await self.app(scope, receive, send)
+            return
+        
+        responder = GZipResponder(self.app, self.minimum_size, compresslevel=self.compresslevel)
+        responder.send = send
+        event_stream = False
+        
+        async def send_selectively(message):
+            nonlocal event_stream
+            # The content type is only known once the response starts
+            if message["type"] == "http.response.start":
+                content_type = Headers(raw=message["headers"]).get("content-type", "")
+                event_stream = content_type.startswith("text/event-stream")
+            if event_stream:
+                await send(message)
+            else:
+                await responder.send_with_gzip(message)
+        
+        await self.app(scope, receive, send_selectively)
+
+# Compress generated analyses, which are typically several KB of text
+app.add_middleware(SelectiveGZipMiddleware, minimum_size=1024, compresslevel=5)
+
 # Add logging middleware
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
-    logger.info(f"Incoming request: {request.method} {request.url}")
-    logger.info(f"Headers: {request.headers}")
-    logger.info(f"Origin: {request.headers.get('origin', 'No origin header')}")
-    
-    # Log the request body for debugging
-    body = await request.body()
-    if body:
-        logger.info(f"Request body: {body.decode()}")
+    # The request body is not read here so the route handler receives it unbuffered
+    debug = logger.isEnabledFor(logging.DEBUG)
+    if debug:
+        logger.debug("Incoming request: %s %s", request.method, request.url)
+        logger.debug("Headers: %s", request.headers)
+        logger.debug("Origin: %s", request.headers.get("origin", "No origin header"))
     
     response = await call_next(request)
     
-    logger.info(f"Response status: {response.status_code}")
+    if debug:
+        logger.debug("Response status: %s", response.status_code)
     return response
 
-# Options endpoint to handle preflight requests explicitly
-@app.options("/generate")
-async def options_generate():
-    return {}
+# Malformed model answers and OpenAI API errors are expected at runtime; their tracebacks only
+# point back into this module or the SDK, so they are logged without one
+EXPECTED_ERRORS = (ValueError, APIError)
 
 # Error handler
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
-    logger.error(f"Error processing request: {exc}", exc_info=True)
-    return JSONResponse(
+    logger.error("Error processing request: %s", exc, exc_info=True)
+    return ORJSONResponse(
         status_code=500,
         content={"detail": str(exc)}
     )
 
-# Initialize OpenAI client
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# The OpenAI client is created on first use, with one connection pool per process tuned for
+# many concurrent long-lived LLM calls
+@functools.lru_cache
+def get_client() -> AsyncOpenAI:
+    return AsyncOpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        http_client=httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=256, max_keepalive_connections=128),
+            # Non-streaming batched completions can take minutes before the first byte arrives
+            timeout=httpx.Timeout(600.0, connect=5.0)
+        )
+    )
+
+# Request batching configuration
+MODEL = os.getenv("OPENAI_MODEL", "gpt-4-turbo")
+MAX_WAIT_MS = int(os.getenv("MAX_WAIT_MS", "100"))
+MAX_TOKENS_PER_COMPANY = 2000
+MAX_COMPLETION_TOKENS = int(os.getenv("MAX_COMPLETION_TOKENS", "4096"))
+# A batch never holds more companies than can each get MAX_TOKENS_PER_COMPANY of the completion
+MAX_BATCH = max(1, min(int(os.getenv("MAX_BATCH", "8")), MAX_COMPLETION_TOKENS // MAX_TOKENS_PER_COMPANY))
+
+# Pending (company_name, feedback, future) items waiting to be batched. Created on startup so it
+# binds to the event loop that serves requests.
+_queue: Optional[asyncio.Queue] = None
+# Keep references to running batch tasks so they are not garbage collected
+_batch_tasks = set()
+
+# Maximum companies from one /generate_many request analyzed at the same time
+GENERATE_MANY_CONCURRENCY = int(os.getenv("GENERATE_MANY_CONCURRENCY", "20"))
+
+# Limits on outgoing chat completion calls, so bursts queue locally instead of hitting 429s. The
+# configured values are for the whole service, so each worker process enforces its share.
+WORKERS = max(1, int(os.getenv("UVICORN_WORKERS", "1")))
+_SEM = asyncio.Semaphore(max(1, int(os.getenv("OPENAI_CONCURRENCY", "50")) // WORKERS))
+_RATE_LIMITER = AsyncLimiter(max(1, int(os.getenv("OPENAI_RPM", "500")) // WORKERS), 60)
+
+# Analysis cache configuration
+CACHE_TTL_SECONDS = int(os.getenv("CACHE_TTL_SECONDS", "3600"))
+CACHE_MAX_SIZE = 1024
+
+# In-process cache of key -> (expiry time, (generated_output, structured_data))
+_cache: Dict[str, Tuple[float, Tuple[str, Dict]]] = {}
+# Optional second tier shared across workers
+redis_client = redis.from_url(os.environ["REDIS_URL"]) if os.getenv("REDIS_URL") else None
+
+# Analyses currently being generated, by cache key
+_inflight: Dict[str, asyncio.Task] = {}
 
 class TopCompetitor(BaseModel):
     name: str
@@ -69,70 +153,560 @@ class PreviousData(BaseModel):
     pass
 
 class CurrentPromptData(BaseModel):
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
     existing_generated_output: str
     user_feedback: str
 
 class CompetitorAnalysisRequest(BaseModel):
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
     company_name: str
-    previous_data: Optional[Dict] = {}
+    previous_data: Optional[Dict] = Field(default_factory=dict)
     current_prompt_data: Optional[CurrentPromptData] = None
-    other_input_data: Optional[Dict] = {}
+    other_input_data: Optional[Dict] = Field(default_factory=dict)
+
+class CompetitorStructuredData(BaseModel):
+    top_competitors: List[TopCompetitor]
 
 class CompetitorAnalysisResponse(BaseModel):
     generated_output: str
-    structured_data: Dict
+    structured_data: CompetitorStructuredData
+
+class CompetitorAnalysisResult(BaseModel):
+    company_name: str
+    generated_output: Optional[str] = None
+    structured_data: Optional[CompetitorStructuredData] = None
+    error: Optional[str] = None
+
+class BatchResult(BaseModel):
+    custom_id: str
+    generated_output: Optional[str] = None
+    structured_data: Optional[CompetitorStructuredData] = None
+    error: Optional[str] = None
+
+class BatchJobResponse(BaseModel):
+    batch_id: str
+    status: str
+    results: Optional[List[BatchResult]] = None
+
+_ANALYST_PROMPT = """You are an expert in competitive analysis for loyalty programs. Analyze the competitors 
+    and provide insights about their loyalty programs, focusing on strengths, weaknesses, and key features."""
+
+_COMPETITORS_FORMAT = """{"name": "...", "strengths": ["..."], "weaknesses": ["..."], "loyalty_program_features": ["..."]}"""
+
+SYSTEM_PROMPT = _ANALYST_PROMPT + f"""
+
+    The request lists the companies to analyze by number. Respond with a JSON object that has one key
+    per company number, holding that company's narrative analysis and structured data about its top
+    competitors, in exactly this format:
+    {{"1": {{"analysis": "...", "top_competitors": [{_COMPETITORS_FORMAT}]}}}}"""
+
+# Streaming relays the narrative as it is generated, so it keeps plain text followed by a marked JSON block
+STREAM_SYSTEM_PROMPT = _ANALYST_PROMPT + f"""
+
+    First write a narrative analysis. Then output structured data about the company's top
+    competitors between [JSON_START] and [JSON_END] markers, using exactly this JSON format:
+    {{"top_competitors": [{_COMPETITORS_FORMAT}]}}"""
+
+# Shared by every request so the system messages are built once at import time
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+STREAM_SYSTEM_MESSAGE = {"role": "system", "content": STREAM_SYSTEM_PROMPT}
+
+def construct_user_prompt(items: List[Tuple[str, str]]) -> str:
+    sections = "\n\n".join(
+        f"{number}. Analyze competitors and loyalty programs for {company_name}." +
+        (f"\n   Consider this feedback: {feedback}" if feedback else "")
+        for number, (company_name, feedback) in enumerate(items, start=1)
+    )
+    return f"Analyze each of the following companies:\n\n{sections}"
+
+def build_messages(items: List[Tuple[str, str]], system_message: Dict = SYSTEM_MESSAGE) -> List[Dict]:
+    return [system_message, {"role": "user", "content": construct_user_prompt(items)}]
+
+_JSON_RE = re.compile(r"\[JSON_START\](.*?)\[JSON_END\]", re.DOTALL)
+
+def extract_json_from_text(text: str) -> Tuple[str, Dict]:
+    """Split a streamed response into the narrative before [JSON_START] and the parsed JSON block."""
+    match = _JSON_RE.search(text)
+    if not match:
+        raise ValueError("Structured data markers not found in response")
+    return text[:match.start()].strip(), orjson.loads(match.group(1))
+
+def parse_company_analysis(analyses: Dict, number: int) -> Tuple[str, Dict]:
+    """Pick one company's (generated_output, structured_data) out of a JSON mode response.
+
+    The structured data is validated here so a malformed answer is never cached.
+    """
+    analysis = analyses.get(str(number))
+    if not isinstance(analysis, dict) or not isinstance(analysis.get("analysis"), str):
+        raise ValueError(f"Analysis for company {number} not found in response")
+    structured_data = CompetitorStructuredData.model_validate({"top_competitors": analysis.get("top_competitors")})
+    return analysis["analysis"], structured_data.model_dump()
+
+def get_feedback(request: CompetitorAnalysisRequest) -> str:
+    return request.current_prompt_data.user_feedback if request.current_prompt_data else ""
+
+def fail_batch_items(items: List[Tuple[str, str, asyncio.Future]], error: Exception):
+    for _, _, future in items:
+        if not future.done():
+            future.set_exception(error)
+
+async def process_batch(batch: List[Tuple[str, str, asyncio.Future]]):
+    """Analyze a batch of companies with a single chat completion and resolve each caller's future."""
+    logger.info("Generating analysis for batch of %s companies", len(batch))
+    try:
+        async with _SEM, _RATE_LIMITER:
+            response = await get_client().chat.completions.create(
+                model=MODEL,
+                messages=build_messages([(name, feedback) for name, feedback, _ in batch]),
+                response_format={"type": "json_object"},
+                temperature=0.7,
+                max_tokens=MAX_TOKENS_PER_COMPANY * len(batch)
+            )
+        choice = response.choices[0]
+        truncated = choice.finish_reason == "length"
+        if truncated and len(batch) == 1:
+            raise ValueError("Analysis was cut off at max_tokens")
+        analyses = None if truncated else orjson.loads(choice.message.content)
+    except Exception as e:
+        logger.error("Error generating batched analysis: %s", e, exc_info=not isinstance(e, EXPECTED_ERRORS))
+        fail_batch_items(batch, e)
+        return
+
+    if truncated:
+        # A JSON mode answer cut off at max_tokens cannot be parsed at all, so give each company its own call
+        logger.warning("Batched analysis was cut off at max_tokens, retrying %s companies individually", len(batch))
+        await asyncio.gather(*[process_batch([item]) for item in batch])
+        return
+
+    for number, (company_name, _, future) in enumerate(batch, start=1):
+        if future.done():
+            continue
+        try:
+            future.set_result(parse_company_analysis(analyses, number))
+        except Exception as e:
+            logger.error("Error parsing analysis for %s: %s", company_name, e)
+            future.set_exception(e)
+
+def fail_queued_items(error: Exception):
+    while _queue is not None and not _queue.empty():
+        fail_batch_items([_queue.get_nowait()], error)
+
+async def batch_worker():
+    """Coalesce queued requests that arrive within MAX_WAIT_MS into batches of up to MAX_BATCH."""
+    loop = asyncio.get_running_loop()
+    batch = []
+    try:
+        while True:
+            batch = [await _queue.get()]
+            deadline = loop.time() + MAX_WAIT_MS / 1000
+            while len(batch) < MAX_BATCH:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(_queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            task = asyncio.create_task(process_batch(batch))
+            _batch_tasks.add(task)
+            task.add_done_callback(_batch_tasks.discard)
+            batch = []
+    finally:
+        # Items already taken off the queue would otherwise wait forever
+        fail_batch_items(batch, RuntimeError("Batch worker stopped"))
+
+def on_batch_worker_done(task: asyncio.Task):
+    if not task.cancelled() and task.exception():
+        logger.error("Batch worker crashed: %s", task.exception(), exc_info=task.exception())
+    fail_queued_items(RuntimeError("Batch worker stopped"))
+
+@app.on_event("startup")
+async def start_batch_worker():
+    global _queue
+    _queue = asyncio.Queue()
+    app.state.batch_worker = asyncio.create_task(batch_worker())
+    app.state.batch_worker.add_done_callback(on_batch_worker_done)
+
+@app.on_event("shutdown")
+async def stop_batch_worker():
+    app.state.batch_worker.cancel()
+    fail_queued_items(RuntimeError("Service is shutting down"))
+
+@app.on_event("shutdown")
+async def close_client():
+    # Skip clients that were never created, rather than creating one just to close it
+    if get_client.cache_info().currsize:
+        await get_client().close()
+        # The next startup in this process must get a fresh client, not the closed one
+        get_client.cache_clear()
+
+@app.on_event("shutdown")
+async def close_redis():
+    if redis_client:
+        await redis_client.aclose()
+
+def cache_key(company_name: str, feedback: str) -> str:
+    return hashlib.blake2b(f"{company_name}|{feedback}".encode(), digest_size=16).hexdigest()
+
+def store_local(key: str, result: Tuple[str, Dict]):
+    if key not in _cache and len(_cache) >= CACHE_MAX_SIZE:
+        # Evict the oldest entry
+        del _cache[next(iter(_cache))]
+    _cache[key] = (time.monotonic() + CACHE_TTL_SECONDS, result)
+
+async def get_cached_analysis(key: str) -> Optional[Tuple[str, Dict]]:
+    entry = _cache.get(key)
+    if entry:
+        expires_at, result = entry
+        if expires_at > time.monotonic():
+            return result
+        del _cache[key]
+    
+    if redis_client:
+        try:
+            cached = await redis_client.get(f"analysis:{key}")
+        except Exception as e:
+            logger.warning("Error reading analysis cache: %s", e)
+            return None
+        if cached:
+            # A corrupt or old-format entry is a miss; the fresh analysis will overwrite it
+            try:
+                generated_output, structured_data = json.loads(cached)
+            except (ValueError, TypeError) as e:
+                logger.warning("Ignoring unreadable cached analysis: %s", e)
+                return None
+            result = (generated_output, structured_data)
+            store_local(key, result)
+            return result
+    return None
+
+async def cache_analysis(key: str, result: Tuple[str, Dict]):
+    store_local(key, result)
+    if redis_client:
+        try:
+            await redis_client.set(f"analysis:{key}", json.dumps(result), ex=CACHE_TTL_SECONDS)
+        except Exception as e:
+            logger.warning("Error writing analysis cache: %s", e)
+
+async def queue_for_batch(company_name: str, feedback: str) -> Tuple[str, Dict]:
+    """Queue a company for the next batch and wait for its (generated_output, structured_data).
+
+    Requests with feedback are analyzed on their own.
+    """
+    future = asyncio.get_running_loop().create_future()
+    item = (company_name, feedback, future)
+    if feedback:
+        # Free-text feedback could steer the analyses of other callers' companies, so it is never
+        # batched with them
+        await process_batch([item])
+    else:
+        if _queue is None or app.state.batch_worker.done():
+            raise RuntimeError("Batch worker is not running")
+        await _queue.put(item)
+    return await future
+
+async def generate_and_cache(key: str, company_name: str, feedback: str) -> Tuple[str, Dict]:
+    result = await queue_for_batch(company_name, feedback)
+    await cache_analysis(key, result)
+    return result
+
+async def generate_competitor_analysis(company_name: str, feedback: str, force: bool = False) -> Tuple[str, Dict]:
+    """Return a cached analysis for identical inputs, otherwise generate one. force skips the cache lookup."""
+    key = cache_key(company_name, feedback)
+    if not force:
+        cached = await get_cached_analysis(key)
+        if cached:
+            logger.info("Cache hit for company: %s", company_name)
+            return cached
+    
+    # Identical requests already being generated share the same task
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(generate_and_cache(key, company_name, feedback))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    else:
+        logger.info("Joining in-flight analysis for company: %s", company_name)
+    # Shield the shared task so one caller disconnecting does not cancel it for the others
+    return await asyncio.shield(task)
+
+def analysis_etag(result: Tuple[str, Dict]) -> str:
+    """Weak ETag over the analysis content; gzip and re-serialization change bytes, not meaning."""
+    content = orjson.dumps(result, option=orjson.OPT_SORT_KEYS)
+    return f'W/"{hashlib.blake2b(content, digest_size=16).hexdigest()}"'
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    # If-None-Match uses weak comparison, so ignore the W/ prefix on both sides
+    opaque = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == opaque for tag in if_none_match.split(","))
+
+def cache_headers(result: Tuple[str, Dict]) -> Dict[str, str]:
+    return {
+        "ETag": analysis_etag(result),
+        "Cache-Control": f"public, max-age={CACHE_TTL_SECONDS}, stale-while-revalidate=86400"
+    }
+
+async def run_analysis(company_name: str, feedback: str, force: bool) -> Tuple[str, Dict]:
+    try:
+        return await generate_competitor_analysis(company_name, feedback, force)
+    except Exception as e:
+        logger.error("Error generating analysis: %s", e, exc_info=not isinstance(e, EXPECTED_ERRORS))
+        raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/generate", response_model=CompetitorAnalysisResponse)
-async def generate_analysis(request: CompetitorAnalysisRequest):
-    logger.info(f"Received analysis request for company: {request.company_name}")
+async def generate_analysis(
+    request: CompetitorAnalysisRequest,
+    response: Response,
+    force: bool = False
+):
+    logger.info("Received analysis request for company: %s", request.company_name)
     
     # Extract user feedback if available
-    feedback = request.current_prompt_data.user_feedback if request.current_prompt_data else ""
+    feedback = get_feedback(request)
     
     # Generate analysis using OpenAI
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=[
-                {
-                    "role": "system",
-                    "content": """You are an expert in competitive analysis for loyalty programs. Analyze the competitors 
-                    and provide insights about their loyalty programs, focusing on strengths, weaknesses, and key features."""
-                },
-                {
-                    "role": "user",
-                    "content": f"Analyze competitors and loyalty programs for {request.company_name}." +
-                              (f"\n\nConsider this feedback: {feedback}" if feedback else "")
-                }
-            ],
-            temperature=0.7,
-            max_tokens=2000
+    result = await run_analysis(request.company_name, feedback, force)
+    generated_output, structured_data = result
+    
+    # POST responses are not reused by shared caches; conditional requests go through GET /generate
+    response.headers["ETag"] = analysis_etag(result)
+    return CompetitorAnalysisResponse(
+        generated_output=generated_output,
+        structured_data=structured_data
+    )
+
+@app.get("/generate", response_model=CompetitorAnalysisResponse)
+async def get_analysis(
+    http_request: Request,
+    response: Response,
+    company_name: str,
+    feedback: str = "",
+    force: bool = False
+):
+    """Cacheable form of POST /generate that answers If-None-Match with 304 Not Modified."""
+    logger.info("Received analysis request for company: %s", company_name)
+    
+    # Only answer 304 when the cached analysis is still the one the client holds
+    if_none_match = http_request.headers.get("if-none-match", "")
+    if not force and if_none_match:
+        cached = await get_cached_analysis(cache_key(company_name, feedback))
+        if cached and etag_matches(if_none_match, analysis_etag(cached)):
+            return Response(status_code=304, headers=cache_headers(cached))
+    
+    result = await run_analysis(company_name, feedback, force)
+    generated_output, structured_data = result
+    
+    response.headers.update(cache_headers(result))
+    return CompetitorAnalysisResponse(
+        generated_output=generated_output,
+        structured_data=structured_data
+    )
+
+@app.post("/generate_many", response_model=List[CompetitorAnalysisResult])
+async def generate_many(requests: List[CompetitorAnalysisRequest], force: bool = False):
+    logger.info("Received analysis request for %s companies", len(requests))
+    semaphore = asyncio.Semaphore(GENERATE_MANY_CONCURRENCY)
+    
+    async def analyze(request: CompetitorAnalysisRequest) -> CompetitorAnalysisResult:
+        async with semaphore:
+            generated_output, structured_data = await generate_competitor_analysis(
+                request.company_name, get_feedback(request), force
+            )
+        return CompetitorAnalysisResult(
+            company_name=request.company_name,
+            generated_output=generated_output,
+            structured_data=structured_data
         )
+    
+    results = await asyncio.gather(*[analyze(request) for request in requests], return_exceptions=True)
+    
+    # Report failures per company so one failed analysis does not fail the whole request
+    return [
+        CompetitorAnalysisResult(company_name=request.company_name, error=str(result))
+        if isinstance(result, BaseException) else result
+        for request, result in zip(requests, results)
+    ]
+
+async def stream_competitor_analysis(company_name: str, feedback: str, force: bool = False):
+    """Relay the narrative as Server-Sent Events, then send the parsed JSON as a structured_data event."""
+    key = cache_key(company_name, feedback)
+    cached = None if force else await get_cached_analysis(key)
+    if cached:
+        generated_output, structured_data = cached
+        yield f"data: {json.dumps({'delta': generated_output})}\n\n"
+        yield f"event: structured_data\ndata: {CompetitorStructuredData.model_validate(structured_data).model_dump_json()}\n\n"
+        return
+    
+    try:
+        # Hold the concurrency slot until the stream is fully consumed
+        async with _SEM, _RATE_LIMITER:
+            stream = await get_client().chat.completions.create(
+                model=MODEL,
+                messages=build_messages([(company_name, feedback)], STREAM_SYSTEM_MESSAGE),
+                temperature=0.7,
+                max_tokens=MAX_TOKENS_PER_COMPANY,
+                stream=True
+            )
         
-        # Extract the response text
-        full_response = response.choices[0].message.content
+            full_response = ""
+            pending = ""
+            json_started = False
+            async for chunk in stream:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if not delta:
+                    continue
+                full_response += delta
+                if json_started:
+                    continue
+            
+                # Only the narrative before [JSON_START] is relayed; the JSON tail is parsed once the stream closes
+                pending += delta
+                if "[JSON_START]" in pending:
+                    prose = pending[:pending.find("[JSON_START]")]
+                    json_started = True
+                else:
+                    # Hold back only a tail that could still grow into [JSON_START]
+                    marker_start = pending.rfind("[")
+                    if marker_start != -1 and "[JSON_START]".startswith(pending[marker_start:]):
+                        prose, pending = pending[:marker_start], pending[marker_start:]
+                    else:
+                        prose, pending = pending, ""
+                if prose:
+                    yield f"data: {json.dumps({'delta': prose})}\n\n"
         
-        # Mock structured data for now
-        structured_data = {
-            "top_competitors": [
-                {
-                    "name": "Competitor A",
-                    "strengths": ["Market leadership", "Digital integration"],
-                    "weaknesses": ["Complex redemption", "Limited personalization"],
-                    "loyalty_program_features": ["Points system", "Mobile app"]
-                }
-            ]
+        result = extract_json_from_text(full_response)
+        structured_data = CompetitorStructuredData.model_validate(result[1])
+        await cache_analysis(key, result)
+        yield f"event: structured_data\ndata: {structured_data.model_dump_json()}\n\n"
+        
+    except Exception as e:
+        logger.error("Error streaming analysis: %s", e, exc_info=not isinstance(e, EXPECTED_ERRORS))
+        yield f"event: error\ndata: {json.dumps({'detail': str(e)})}\n\n"
+
+@app.post("/generate/stream")
+async def generate_analysis_stream(request: CompetitorAnalysisRequest, force: bool = False):
+    logger.info("Received streaming analysis request for company: %s", request.company_name)
+    return StreamingResponse(
+        stream_competitor_analysis(request.company_name, get_feedback(request), force),
+        media_type="text/event-stream"
+    )
+
+async def submit_batch(requests: List[CompetitorAnalysisRequest]):
+    """Upload the requests as a JSONL file and create an OpenAI Batch job for them."""
+    buffer = io.StringIO()
+    for index, request in enumerate(requests):
+        line = {
+            "custom_id": str(index),
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": MODEL,
+                "messages": build_messages([(request.company_name, get_feedback(request))]),
+                "response_format": {"type": "json_object"},
+                "temperature": 0.7,
+                "max_tokens": MAX_TOKENS_PER_COMPANY
+            }
         }
+        buffer.write(json.dumps(line) + "\n")
+    
+    batch_file = await get_client().files.create(
+        file=("competitor_analysis_batch.jsonl", buffer.getvalue().encode()),
+        purpose="batch"
+    )
+    return await get_client().batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+
+def parse_batch_results(text: str, total: int) -> List[BatchResult]:
+    """Build one result per submitted request from the batch's output and error file lines."""
+    results = {}
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError as e:
+            logger.warning("Skipping unreadable batch result line: %s", e)
+            continue
+        custom_id = str(item.get("custom_id"))
+        try:
+            if item.get("error"):
+                raise ValueError(item["error"].get("message", "Batch request failed"))
+            response = item["response"]
+            if response["status_code"] != 200:
+                error = (response.get("body") or {}).get("error") or {}
+                raise ValueError(error.get("message", f"Batch request returned status {response['status_code']}"))
+            content = response["body"]["choices"][0]["message"]["content"]
+            generated_output, structured_data = parse_company_analysis(orjson.loads(content), 1)
+            results[custom_id] = BatchResult(
+                custom_id=custom_id,
+                generated_output=generated_output,
+                structured_data=structured_data
+            )
+        except Exception as e:
+            results[custom_id] = BatchResult(custom_id=custom_id, error=str(e))
+    
+    # custom_id is the request's index in the submitted list, so fill any gaps and return them in order
+    return [
+        results.get(str(index)) or BatchResult(custom_id=str(index), error="No result returned for this request")
+        for index in range(total)
+    ]
+
+@app.post("/generate_batch", response_model=BatchJobResponse)
+async def generate_batch(requests: List[CompetitorAnalysisRequest]):
+    logger.info("Received batch analysis request for %s companies", len(requests))
+    
+    try:
+        batch = await submit_batch(requests)
+        return BatchJobResponse(batch_id=batch.id, status=batch.status)
         
-        return CompetitorAnalysisResponse(
-            generated_output=full_response,
-            structured_data=structured_data
-        )
+    except Exception as e:
+        logger.error("Error submitting batch: %s", e, exc_info=not isinstance(e, EXPECTED_ERRORS))
+        raise HTTPException(status_code=500, detail=str(e))
+
+BATCH_FINAL_STATUSES = ("completed", "expired", "cancelled")
+
+@app.get("/batch/{batch_id}", response_model=BatchJobResponse)
+async def get_batch(batch_id: str):
+    try:
+        batch = await get_client().batches.retrieve(batch_id)
+        # Expired and cancelled jobs still write files for the requests that ran before they stopped
+        if batch.status not in BATCH_FINAL_STATUSES:
+            return BatchJobResponse(batch_id=batch.id, status=batch.status)
+        
+        # Successful requests are written to the output file and failed ones to the error file
+        texts = []
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                content = await get_client().files.content(file_id)
+                texts.append(content.text)
+        # Output files can hold thousands of analyses; parse them off the event loop
+        results = await asyncio.to_thread(parse_batch_results, "\n".join(texts), batch.request_counts.total)
+        return BatchJobResponse(batch_id=batch.id, status=batch.status, results=results)
         
     except Exception as e:
-        logger.error(f"Error generating analysis: {e}", exc_info=True)
+        logger.error("Error retrieving batch %s: %s", batch_id, e, exc_info=not isinstance(e, EXPECTED_ERRORS))
         raise HTTPException(status_code=500, detail=str(e))
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # The service is I/O bound, so a few workers are enough. Export the count so each worker
+    # process can split the OpenAI limits.
+    workers = int(os.getenv("UVICORN_WORKERS", "2"))
+    os.environ["UVICORN_WORKERS"] = str(workers)
+    # Multiple workers require the app to be passed as an import string
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=workers,
+        loop="uvloop",
+        http="httptools",
+        limit_concurrency=1024,
+        backlog=2048,
+        log_level=os.getenv("UVICORN_LOG_LEVEL", "warning")
+    )